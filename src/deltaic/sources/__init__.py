@@ -169,6 +169,7 @@ class _SourceBackupTask(Task):
 
 class Source:
     LABEL: Optional[str] = None
+    DEFAULT_WORKERS = 1
 
     def __init__(self, config):
         self._settings = config.get("settings", {})
@@ -187,5 +188,5 @@ class Source:
         raise NotImplementedError
 
     def get_backup_task(self):
-        thread_count = self._settings.get(f"{self.LABEL}-workers", 1)
+        thread_count = self._settings.get(f"{self.LABEL}-workers", self.DEFAULT_WORKERS)
         return _SourceBackupTask(self._settings, thread_count, self.get_units())
@@ -19,6 +19,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import atexit
 import os
 import re
 import shutil
@@ -26,8 +27,10 @@ import stat
 import subprocess
 import sys
 import tarfile
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional
+from threading import BoundedSemaphore
+from typing import Any, Dict, Optional, Set, Union
 
 import click
 
@@ -35,78 +38,127 @@ from ..command import pass_config
 from ..platform import lutime
 from ..util import (
     BloomSet,
+    DigestSet,
+    LogSink,
     XAttrs,
     gc_directory_tree,
     make_dir_path,
     random_do_work,
     update_file,
+    write_atomic,
 )
-from . import Source, Unit
+from . import Source, Unit, _SourceBackupTask
 
+BLOCKSIZE = 256 << 10
 ATTR_INCREMENTAL = "user.coda.incremental-ok"
 ATTR_STAT = "user.rsync.%stat"
 DUMP_ATTEMPTS = 10
+# Tar entry types produced by codadump2tar, and the corresponding stat
+# file types.  Coda apparently doesn't allow hard links to symlinks.
+TAR_STAT_TYPES = {
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.REGTYPE: stat.S_IFREG,
+    tarfile.LNKTYPE: stat.S_IFREG,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+}
+# Idle time before a shared ssh connection to a Coda server exits.  The
+# master process outlives the backup run by up to this long.
+SSH_CONTROL_PERSIST = "60s"
+VOLUME_ID_RE = re.compile("^id = ([0-9a-f]+)")
+BACKUP_ID_RE = re.compile(", backupId = ([0-9a-f]+)")
+
+# Per-object progress output is buffered; see LogSink
+_log_sink = LogSink()
+atexit.register(_log_sink.flush)
+_log = _log_sink.log
 
 
 class DumpError(Exception):
     pass
 
 
-def volutil_cmd(host, subcommand, args=(), volutil=None):
+def get_ssh_control_dir(root_dir):
+    """Return a private directory for ssh control sockets, creating it if
+    needed."""
+    path = make_dir_path(root_dir, "Sockets")
+    if stat.S_IMODE(os.stat(path).st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+def volutil_cmd(host, subcommand, args=(), volutil=None, control_dir=None):
     if volutil is None:
         volutil = "volutil"
     print(">", volutil, subcommand, " ".join(args))
-    return [
-        "ssh",
-        "-o",
-        "BatchMode=yes",
-        "-o",
-        "StrictHostKeyChecking=no",
-        f"root@{host}",
-        volutil,
-        subcommand,
-    ] + list(args)
+    cmd = ["ssh", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=no"]
+    if control_dir is not None:
+        # Share one connection across the several volutil invocations we
+        # make for each volume, rather than paying for a new handshake.
+        # %C is a hash of the connection parameters, which keeps the
+        # socket path under the sun_path length limit.
+        cmd.extend(
+            [
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={os.path.join(control_dir, 'coda-%C')}",
+                "-o",
+                f"ControlPersist={SSH_CONTROL_PERSIST}",
+            ]
+        )
+    return cmd + [f"root@{host}", volutil, subcommand] + list(args)
 
 
 def get_err_stream(verbose):
     return None if verbose else subprocess.DEVNULL
 
 
-def get_volume_ids(host, volume, verbose=False, volutil=None):
-    try:
-        info = subprocess.run(
-            volutil_cmd(host, "info", [volume], volutil=volutil),
-            stdout=subprocess.PIPE,
-            stderr=get_err_stream(verbose),
-            encoding=sys.stdout.encoding,
-            check=True,
-        ).stdout
-    except subprocess.CalledProcessError:
+def get_volume_ids(host, volume, verbose=False, volutil=None, control_dir=None):
+    volume_id = backup_id = None
+    with subprocess.Popen(
+        volutil_cmd(host, "info", [volume], volutil=volutil, control_dir=control_dir),
+        stdout=subprocess.PIPE,
+        stderr=get_err_stream(verbose),
+        encoding=sys.stdout.encoding,
+    ) as proc:
+        assert proc.stdout is not None
+        for line in proc.stdout:
+            if volume_id is None:
+                match = VOLUME_ID_RE.match(line)
+                if match is not None:
+                    volume_id = match.group(1)
+            if backup_id is None:
+                match = BACKUP_ID_RE.search(line)
+                if match is not None:
+                    backup_id = match.group(1)
+            if volume_id is not None and backup_id is not None:
+                # We have what we need; don't wait for the rest
+                proc.terminate()
+                return volume_id, backup_id
+
+    if proc.returncode:
         raise OSError(f"Couldn't get volume info for {volume}")
-
-    match = re.search("^id = ([0-9a-f]+)", info, re.MULTILINE)
-    if match is None:
+    if volume_id is None:
         raise ValueError(f"Couldn't find volume ID for {volume}")
-    volume_id = match.group(1)
-
-    match = re.search(", backupId = ([0-9a-f]+)", info)
-    if match is None:
-        raise ValueError(f"Couldn't find backup ID for {volume}")
-    backup_id = match.group(1)
+    raise ValueError(f"Couldn't find backup ID for {volume}")
 
-    return volume_id, backup_id
 
-
-def refresh_backup_volume(host, volume, verbose=False, volutil=None):
-    volume_id, _ = get_volume_ids(host, volume, verbose, volutil=volutil)
+def refresh_backup_volume(host, volume, verbose=False, volutil=None, control_dir=None):
+    volume_id, _ = get_volume_ids(
+        host, volume, verbose, volutil=volutil, control_dir=control_dir
+    )
     subprocess.run(
-        volutil_cmd(host, "lock", [volume_id], volutil=volutil),
+        volutil_cmd(
+            host, "lock", [volume_id], volutil=volutil, control_dir=control_dir
+        ),
         stdout=get_err_stream(verbose),
         stderr=get_err_stream(verbose),
         check=True,
     )
     subprocess.run(
-        volutil_cmd(host, "backup", [volume_id], volutil=volutil),
+        volutil_cmd(
+            host, "backup", [volume_id], volutil=volutil, control_dir=control_dir
+        ),
         stdout=get_err_stream(verbose),
         stderr=get_err_stream(verbose),
         check=True,
@@ -142,20 +194,23 @@ class TarMemberFile:
         self._file.close()
 
 
-def update_dir_from_tar(tar, root_dir):
+def update_dir_from_tar(tar, root_dir, bloom_gc=False):
     directories = []
-    valid_paths = BloomSet()
+    # Directories whose mtime we've changed by modifying their contents
+    dirty_dirs: Set[Path] = set()
+    # Track valid paths exactly unless the volume is too large for that
+    valid_paths: Union[BloomSet, DigestSet] = BloomSet() if bloom_gc else DigestSet()
     for entry in tar:
+        # Fetch TarInfo attributes once; this loop runs for every object
+        # in the volume
+        etype = entry.type
+        mtime = entry.mtime
+
         # Convert entry type to stat constant
-        if entry.type == tarfile.DIRTYPE:
-            entry_stat_type = stat.S_IFDIR
-        elif entry.type in (tarfile.REGTYPE, tarfile.LNKTYPE):
-            # Coda apparently doesn't allow hard links to symlinks
-            entry_stat_type = stat.S_IFREG
-        elif entry.type == tarfile.SYMTYPE:
-            entry_stat_type = stat.S_IFLNK
-        else:
-            raise ValueError(f"Unexpected file type {entry.type}")
+        try:
+            entry_stat_type = TAR_STAT_TYPES[etype]
+        except KeyError:
+            raise ValueError(f"Unexpected file type {etype}") from None
 
         # Check for existing file
         path = build_path(root_dir, entry.name)
@@ -170,33 +225,49 @@ def update_dir_from_tar(tar, root_dir):
                 shutil.rmtree(path)
             else:
                 os.unlink(path)
+            dirty_dirs.add(path.parent)
             st = None
 
         # Create parent directory if not present.  Parents are not
         # necessarily dumped before children.
-        path.parent.mkdir(parents=True, exist_ok=True)
+        if not path.parent.is_dir():
+            path.parent.mkdir(parents=True)
+            dirty_dirs.update(path.parents)
 
         # Create new object
-        if entry.isdir():
-            if not os.path.exists(path):
-                print("d", path)
+        changed = False
+        if etype == tarfile.DIRTYPE:
+            if st is None:
+                _log("d", path)
                 os.mkdir(path)
+                dirty_dirs.add(path)
+                changed = True
             # Go back and set mtime after directory has been populated
-            directories.append(entry)
-        elif entry.isfile():
+            directories.append((path, mtime, st.st_mtime if st else None))
+        elif etype == tarfile.REGTYPE:
             # update_file() will break hard links if it modifies the file.
             # This is what we want because links may have also been broken
             # at the source.  codadump2tar always dumps hard links, so we
             # will rebuild any links that should still exist.
-            if update_file(path, TarMemberFile(tar, entry)):
-                print("f", path)
-        elif entry.issym():
+            if st is not None and st.st_size == entry.size:
+                changed = update_file(path, TarMemberFile(tar, entry), nocache=True)
+            else:
+                # The file is new or its size has changed, so there's no
+                # point in comparing against the old data
+                with write_atomic(path, nocache=True) as fh:
+                    shutil.copyfileobj(TarMemberFile(tar, entry), fh, BLOCKSIZE)
+                changed = True
+            if changed:
+                _log("f", path)
+        elif etype == tarfile.SYMTYPE:
             if entry.linkname and (st is None or os.readlink(path) != entry.linkname):
-                print("s", path)
+                _log("s", path)
                 if st is not None:
                     os.unlink(path)
                 os.symlink(entry.linkname, path)
-        elif entry.islnk():
+                changed = True
+        else:
+            # Hard link
             target_path = build_path(root_dir, entry.linkname)
             target_st = os.lstat(target_path)
             if (
@@ -204,46 +275,56 @@ def update_dir_from_tar(tar, root_dir):
                 or st.st_dev != target_st.st_dev
                 or st.st_ino != target_st.st_ino
             ):
-                print("l", path)
+                _log("l", path)
                 if st is not None:
                     os.unlink(path)
                 os.link(target_path, path)
+                changed = True
+        if changed:
+            dirty_dirs.add(path.parent)
 
         # Update metadata
-        attrs = XAttrs(path)
         # owner and mode.  Hardlinks were updated with the primary, and we
         # can't set xattrs on symlinks.
-        if entry.isfile() or entry.isdir():
+        if etype in (tarfile.REGTYPE, tarfile.DIRTYPE):
             # rsync --fake-super compatible:
             # octal_mode_with_type major,minor uid:gid
             mode = entry_stat_type | entry.mode
-            attrs.update(
+            XAttrs(path).update(
                 ATTR_STAT,
                 f"{mode:o} 0,0 {entry.uid}:{entry.gid}",
             )
         # mtime.  Directories will be updated later, and hardlinks were
-        # updated with the primary.
-        if (
-            (entry.isfile() or entry.issym())
-            and path.exists()
-            and os.lstat(path).st_mtime != entry.mtime
-        ):
-            lutime(path, entry.mtime)
+        # updated with the primary.  If we didn't replace the object, the
+        # lstat() from above is still current.
+        if etype in (tarfile.REGTYPE, tarfile.SYMTYPE):
+            if changed:
+                st = os.lstat(path)
+            if st is not None and st.st_mtime != mtime:
+                lutime(path, mtime)
 
         # Protect from garbage collection
         valid_paths.add(str(path))
 
-    # Deferred update of directory mtimes
-    for entry in directories:
-        path = build_path(root_dir, entry.name)
-        if os.stat(path).st_mtime != entry.mtime:
-            os.utime(path, (entry.mtime, entry.mtime))
+    # Deferred update of directory mtimes.  A directory whose contents we
+    # haven't touched still has the mtime we saw when we examined it, so
+    # we don't need to stat it again.
+    for path, mtime, old_mtime in directories:
+        if path in dirty_dirs or old_mtime != mtime:
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
 
     return valid_paths
 
 
 def update_dir(
-    host, backup_id, root_dir, incremental=False, volutil=None, codadump2tar=None
+    host,
+    backup_id,
+    root_dir,
+    incremental=False,
+    volutil=None,
+    codadump2tar=None,
+    bloom_gc=False,
+    control_dir=None,
 ):
     if codadump2tar is None:
         codadump2tar = "codadump2tar"
@@ -251,14 +332,14 @@ def update_dir(
     args.extend([backup_id, "|", codadump2tar, "-rn", "."])
 
     proc = subprocess.Popen(
-        volutil_cmd(host, "dump", args, volutil=volutil),
+        volutil_cmd(host, "dump", args, volutil=volutil, control_dir=control_dir),
         stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
     )
 
     try:
         tar = tarfile.open(fileobj=proc.stdout, mode="r|")
-        valid_paths = update_dir_from_tar(tar, root_dir)
+        valid_paths = update_dir_from_tar(tar, root_dir, bloom_gc=bloom_gc)
     except tarfile.ReadError as e:
         raise DumpError(str(e))
 
@@ -275,6 +356,8 @@ def sync_backup_volume(
     verbose=False,
     volutil=None,
     codadump2tar=None,
+    bloom_gc=False,
+    control_dir=None,
 ):
     make_dir_path(root_dir)
 
@@ -288,7 +371,9 @@ def sync_backup_volume(
     if not incremental:
         root_xattrs.delete(ATTR_INCREMENTAL)
 
-    _, backup_id = get_volume_ids(host, volume, verbose, volutil=volutil)
+    _, backup_id = get_volume_ids(
+        host, volume, verbose, volutil=volutil, control_dir=control_dir
+    )
 
     # Retry dump a few times to paper over rpc2 timeouts
     for tries_remaining in range(DUMP_ATTEMPTS - 1, -1, -1):
@@ -300,6 +385,8 @@ def sync_backup_volume(
                 incremental=incremental,
                 volutil=volutil,
                 codadump2tar=codadump2tar,
+                bloom_gc=bloom_gc,
+                control_dir=control_dir,
             )
             break
         except DumpError:
@@ -309,12 +396,15 @@ def sync_backup_volume(
     if not incremental:
 
         def report(path, is_dir):
-            print("-", path)
+            _log("-", path)
 
         gc_directory_tree(root_dir, valid_paths, report)
+    _log_sink.flush()
 
     subprocess.run(
-        volutil_cmd(host, "ancient", [backup_id], volutil=volutil),
+        volutil_cmd(
+            host, "ancient", [backup_id], volutil=volutil, control_dir=control_dir
+        ),
         stderr=get_err_stream(verbose),
         check=True,
     )
@@ -349,8 +439,13 @@ def backup(config, incremental, refresh, verbose, host, volume):
     root_dir = os.path.join(settings["root"], get_relroot(host, volume))
     volutil = settings.get("coda-volutil-path", "volutil")
     codadump2tar = settings.get("coda-codadump2tar-path", "codadump2tar")
+    control_dir = None
+    if settings.get("coda-ssh-multiplex", True):
+        control_dir = get_ssh_control_dir(settings["root"])
     if refresh:
-        refresh_backup_volume(host, volume, verbose=verbose, volutil=volutil)
+        refresh_backup_volume(
+            host, volume, verbose=verbose, volutil=volutil, control_dir=control_dir
+        )
     sync_backup_volume(
         host,
         volume,
@@ -359,6 +454,8 @@ def backup(config, incremental, refresh, verbose, host, volume):
         verbose=verbose,
         volutil=volutil,
         codadump2tar=codadump2tar,
+        bloom_gc=settings.get("coda-bloom-gc", False),
+        control_dir=control_dir,
     )
 
 
@@ -366,11 +463,28 @@ class CodaUnit(Unit):
     def __init__(self, settings, server, volume):
         Unit.__init__(self)
         self.root = get_relroot(server, volume)
+        self.server = server
         self.backup_args = ["coda", "backup", server, volume]
         if random_do_work(settings, "coda-full-probability", 0.143):
             self.backup_args.append("-i")
 
 
+class _CodaBackupTask(_SourceBackupTask):
+    def __init__(self, settings, thread_count, units, server_limit):
+        _SourceBackupTask.__init__(self, settings, thread_count, units)
+        # Limit simultaneous dumps per server, so raising coda-workers
+        # doesn't pile all the jobs onto one server
+        self._server_slots: Dict[str, Any] = {}
+        for unit in units:
+            self._server_slots[unit.server] = (
+                BoundedSemaphore(server_limit) if server_limit else nullcontext()
+            )
+
+    def _execute(self, unit):
+        with self._server_slots[unit.server]:
+            return _SourceBackupTask._execute(self, unit)
+
+
 class CodaSource(Source):
     LABEL = "coda"
 
@@ -381,3 +495,10 @@ class CodaSource(Source):
                 for server in group["servers"]:
                     ret.append(CodaUnit(self._settings, server, volume))
         return ret
+
+    def get_backup_task(self):
+        thread_count = self._settings.get("coda-workers", self.DEFAULT_WORKERS)
+        server_limit = self._settings.get("coda-server-workers")
+        return _CodaBackupTask(
+            self._settings, thread_count, self.get_units(), server_limit
+        )
@@ -19,60 +19,106 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import atexit
 import contextlib
+import hashlib
 import json
 import os
+import random
 import re
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from getpass import getpass
-from typing import Dict, List
+from typing import Any, Dict, List, Optional
 
 import click
 import github3
 import yaml
+from requests.adapters import HTTPAdapter, Retry
 
 from ..command import pass_config
 from ..util import (
     BloomSet,
+    CachedXAttrs,
+    LogSink,
     UpdateFile,
     XAttrs,
     datetime_to_time_t,
     gc_directory_tree,
     make_dir_path,
+    prefetch_iter,
     random_do_work,
-    update_file,
 )
 from . import Source, Unit
 
 ATTR_CONTENT_TYPE = "user.github.content-type"
 ATTR_ETAG = "user.github.etag"
+ATTR_ISSUES_SINCE = "user.github.issues-since"
+ATTR_RELEASE_FINGERPRINT = "user.github.release-fingerprint"
 GIT_ATTEMPTS = 5
+# Seconds to back the issue listing watermark off from the time we started
+# listing, to cover clock skew against GitHub and edits that land while
+# the listing is in flight
+ISSUES_SINCE_MARGIN = 600
+API_THREADS = 4
+# sync_repo() runs three API tasks at once, one of which uses API_THREADS
+# more threads; leave room for all of them to keep a connection alive
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = 5
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 OAUTH_SCOPES = ("read:org", "repo")
 TOKEN_NOTE = "Deltaic GitHub source"
 TOKEN_NOTE_URL = "https://github.com/cmusatyalab/deltaic"
 USER_AGENT = "deltaic-github/1"
 
+# Per-object progress output is buffered; see LogSink
+_log_sink = LogSink()
+atexit.register(_log_sink.flush)
+_log = _log_sink.log
+
 
 def user_str(user):
-    return user.login if user else None
+    # A repo's issues and events name the same few users over and over;
+    # share one string per name while their info dicts are alive
+    return sys.intern(user.login) if user else None
+
+
+def json_default(obj):
+    # Timestamps are stored in the records as datetimes and serialized by
+    # the encoder, instead of being converted one by one while building
+    # the records
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
 
 
-def timestamp_str(timestamp):
-    return timestamp.isoformat() if timestamp else None
+# Reuse one encoder rather than having json.dumps() build a new one for
+# every record.  Output is the same as json.dumps(obj, sort_keys=True).
+json_encoder = json.JSONEncoder(sort_keys=True, default=json_default)
 
 
 def gc_report(path, is_dir):
-    print("-", path)
+    _log("-", path)
 
 
 def write_json(path, info, timestamp=None):
-    if update_file(path, json.dumps(info, sort_keys=True) + "\n"):
-        print("f", path)
+    # Hand UpdateFile the encoded bytes, which it can compare and write
+    # without another copy.  Appending the newline to them would copy the
+    # whole document once more.
+    data = json_encoder.encode(info).encode("utf-8")
+    with UpdateFile(path, size=len(data) + 1) as fh:
+        fh.write(data)
+        fh.write(b"\n")
+    modified = fh.modified
+    if modified:
+        _log("f", path)
     if timestamp is not None:
         mtime = datetime_to_time_t(timestamp)
-        if os.stat(path).st_mtime != mtime:
+        # A freshly written file can't have the right mtime yet
+        if modified or os.stat(path).st_mtime != mtime:
             os.utime(path, (mtime, mtime))
 
 
@@ -85,7 +131,7 @@ class cond_iter:
     the skipped attribute is set to True."""
 
     def __init__(self, path, func, scrub=False, *args, **kwargs):
-        self._attrs = XAttrs(path)
+        self._attrs = CachedXAttrs(path)
         etag = self._attrs.get(ATTR_ETAG)
         if etag and not scrub:
             kwargs["etag"] = etag
@@ -94,23 +140,61 @@ class cond_iter:
 
     def __iter__(self):
         iter = self._func()
-        yield from iter
+        # Fetch the next page while the caller works through this one.
+        # The iterator has finished, and set etag and last_status, by the
+        # time prefetch_iter() returns.
+        yield from prefetch_iter(iter)
         if iter.etag:
             self._attrs.update(ATTR_ETAG, iter.etag)
         self.skipped = iter.last_status == 304
 
 
+def git_refs_unchanged(git_cmd, root_dir, env):
+    # Compare the remote's refs against the mirror's.  If they match, we
+    # can skip the fetch, which would otherwise negotiate with the server
+    # and rewrite FETCH_HEAD even though nothing has changed.
+    try:
+        remote = subprocess.run(
+            git_cmd + ["ls-remote", "origin"],
+            cwd=root_dir,
+            env=env,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            check=True,
+        ).stdout
+        local = subprocess.run(
+            git_cmd + ["for-each-ref", "--format=%(objectname)\t%(refname)"],
+            cwd=root_dir,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            check=True,
+        ).stdout
+    except subprocess.CalledProcessError:
+        return False
+    # Ignore the symbolic HEAD and peeled tags, which the mirror doesn't
+    # store as refs
+    remote_refs = {
+        line
+        for line in remote.splitlines()
+        if not line.endswith("\tHEAD") and not line.endswith("^{}")
+    }
+    return remote_refs == set(local.splitlines())
+
+
 def update_git(
     url, root_dir, token, scrub=False, ignore_clone_errors=False, git_path=None
 ):
     if git_path is None:
         git_path = "git"
+    # Protocol v2 lets the server skip advertising refs we didn't ask
+    # about.  It's the default in newer git versions.
+    git_cmd = [git_path, "-c", "protocol.version=2"]
     exists = os.path.exists(root_dir)
     if not exists:
-        cmd = [git_path, "clone", "--mirror", url, root_dir]
+        cmd = git_cmd + ["clone", "--mirror", url, root_dir]
         cwd = None
     else:
-        cmd = [git_path, "remote", "update", "--prune"]
+        cmd = git_cmd + ["remote", "update", "--prune"]
         cwd = root_dir
 
     askpass = os.path.join(os.path.dirname(sys.argv[0]), "dt-askpass")
@@ -124,7 +208,11 @@ def update_git(
         }
     )
 
-    for tries_remaining in range(GIT_ATTEMPTS - 1, -1, -1):
+    if exists and not scrub and git_refs_unchanged(git_cmd, root_dir, env):
+        return
+
+    for attempt in range(GIT_ATTEMPTS):
+        tries_remaining = GIT_ATTEMPTS - 1 - attempt
         print(" ".join(cmd))
         ret = subprocess.run(cmd, cwd=cwd, env=env)
         if ret.returncode == 0:
@@ -136,8 +224,9 @@ def update_git(
         if not tries_remaining:
             ret.check_returncode()  # raises CalledProcessError
 
-        # sleep and try again
-        time.sleep(1)
+        # Back off exponentially, with jitter so that parallel workers
+        # hitting the same transient failure don't retry in lockstep
+        time.sleep(2**attempt * random.uniform(0.5, 1.5))
 
     if scrub:
         cmd = [git_path, "fsck", "--no-dangling", "--no-progress"]
@@ -145,12 +234,66 @@ def update_git(
         subprocess.run(cmd, cwd=root_dir, check=True)
 
 
+def get_issue_info(issue):
+    if issue.comments:
+        comments = [
+            {
+                "created_at": comment.created_at,
+                "updated_at": comment.updated_at,
+                "user": user_str(comment.user),
+                "body": comment.body,
+            }
+            for comment in issue.iter_comments()
+        ]
+    else:
+        comments = []
+
+    return {
+        "assignee": user_str(issue.assignee),
+        "body": issue.body,
+        "closed_at": issue.closed_at,
+        "closed_by": user_str(issue.closed_by),
+        "comments": comments,
+        "created_at": issue.created_at,
+        "events": [
+            {
+                "actor": user_str(event.actor),
+                "commit_id": event.commit_id,
+                "created_at": event.created_at,
+                "event": sys.intern(event.event),
+            }
+            for event in issue.iter_events()
+        ],
+        "labels": [sys.intern(label.name) for label in issue.labels],
+        "milestone": issue.milestone.number if issue.milestone else None,
+        "number": issue.number,
+        "state": sys.intern(issue.state),
+        "title": issue.title,
+        "updated_at": issue.updated_at,
+        "user": user_str(issue.user),
+    }
+
+
 def update_issues(repo, root_dir, scrub=False):
     # Issues
     valid_paths = BloomSet()
     issue_dir = make_dir_path(root_dir, "issues")
     valid_paths.add(issue_dir)
-    issue_iter = cond_iter(issue_dir, repo.iter_issues, scrub=scrub, state="all")
+    # Unless scrubbing, only list issues updated since the last listing
+    # started.  This can't detect deleted issues, so only scrubs collect
+    # garbage.
+    issue_attrs = CachedXAttrs(issue_dir)
+    since = None if scrub else issue_attrs.get(ATTR_ISSUES_SINCE)
+    # Take the watermark before listing, so issues edited while we page
+    # through the results are picked up next time.  Relisting a few
+    # unchanged issues is cheap: their mtimes match.
+    started = time.strftime(
+        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - ISSUES_SINCE_MARGIN)
+    )
+    issue_iter = cond_iter(
+        issue_dir, repo.iter_issues, scrub=scrub, state="all", since=since
+    )
+    changed = []
     for issue in issue_iter:
         path = os.path.join(issue_dir, f"{issue.number}.json")
         valid_paths.add(path)
@@ -161,47 +304,16 @@ def update_issues(repo, root_dir, scrub=False):
                 issue.updated_at
             ):
                 continue
-
-        if issue.comments:
-            comments = [
-                {
-                    "created_at": timestamp_str(comment.created_at),
-                    "updated_at": timestamp_str(comment.updated_at),
-                    "user": user_str(comment.user),
-                    "body": comment.body,
-                }
-                for comment in issue.iter_comments()
-            ]
-        else:
-            comments = []
-
-        info = {
-            "assignee": user_str(issue.assignee),
-            "body": issue.body,
-            "closed_at": timestamp_str(issue.closed_at),
-            "closed_by": user_str(issue.closed_by),
-            "comments": comments,
-            "created_at": timestamp_str(issue.created_at),
-            "events": [
-                {
-                    "actor": user_str(event.actor),
-                    "commit_id": event.commit_id,
-                    "created_at": timestamp_str(event.created_at),
-                    "event": event.event,
-                }
-                for event in issue.iter_events()
-            ],
-            "labels": [label.name for label in issue.labels],
-            "milestone": issue.milestone.number if issue.milestone else None,
-            "number": issue.number,
-            "state": issue.state,
-            "title": issue.title,
-            "updated_at": timestamp_str(issue.updated_at),
-            "user": user_str(issue.user),
-        }
-        write_json(path, info, issue.updated_at)
-    if not issue_iter.skipped:
+        changed.append((path, issue))
+
+    # Overlap the latency of the per-issue requests
+    with ThreadPoolExecutor(API_THREADS) as executor:
+        infos = executor.map(get_issue_info, (issue for _, issue in changed))
+        for (path, issue), info in zip(changed, infos):
+            write_json(path, info, issue.updated_at)
+    if not issue_iter.skipped and since is None:
         gc_directory_tree(issue_dir, valid_paths, gc_report)
+    issue_attrs.update(ATTR_ISSUES_SINCE, started)
 
     # Milestones
     valid_paths = BloomSet()
@@ -212,13 +324,13 @@ def update_issues(repo, root_dir, scrub=False):
     )
     for milestone in milestone_iter:
         info = {
-            "created_at": timestamp_str(milestone.created_at),
+            "created_at": milestone.created_at,
             "creator": user_str(milestone.creator),
             "description": milestone.description,
-            "due_on": timestamp_str(milestone.due_on),
+            "due_on": milestone.due_on,
             "state": milestone.state,
             "title": milestone.title,
-            "updated_at": timestamp_str(milestone.updated_at),
+            "updated_at": milestone.updated_at,
         }
         path = os.path.join(milestone_dir, f"{milestone.number}.json")
         valid_paths.add(path)
@@ -232,18 +344,18 @@ def update_comments(repo, root_dir, scrub=False):
     valid_paths = BloomSet()
     comment_dir = make_dir_path(root_dir, "comments")
     valid_paths.add(comment_dir)
-    commit_comments: Dict[str, List[Dict[str, str]]] = {}
-    commit_timestamps: Dict[str, str] = {}
+    commit_comments: Dict[str, List[Dict[str, Any]]] = {}
+    commit_timestamps: Dict[str, datetime] = {}
     comment_iter = cond_iter(comment_dir, repo.iter_comments, scrub=scrub)
     for comment in comment_iter:
         info = {
             "body": comment.body,
-            "created_at": timestamp_str(comment.created_at),
+            "created_at": comment.created_at,
             "commit_id": comment.commit_id,
             "line": comment.line,
             "path": comment.path,
             "position": comment.position,
-            "updated_at": timestamp_str(comment.updated_at),
+            "updated_at": comment.updated_at,
             "user": user_str(comment.user),
         }
         commit_id = comment.commit_id
@@ -259,6 +371,27 @@ def update_comments(repo, root_dir, scrub=False):
         gc_directory_tree(comment_dir, valid_paths, gc_report)
 
 
+def download_asset(asset, fh):
+    # Same requests as github3's Asset.download(), which copies the
+    # response body in 512-byte chunks.  This relies on the private _get()
+    # and _boolean() helpers, so it depends on the github3.py < 1.0 pin in
+    # pyproject.toml.
+    headers: Dict[str, Optional[str]] = {"Accept": "application/octet-stream"}
+    resp = asset._get(asset._api, allow_redirects=False, stream=True, headers=headers)
+    if resp.status_code == 302:
+        # Amazon S3 rejects the redirected request unless we omit these
+        headers["Content-Type"] = None
+        # Drop the token for this request only; session.no_auth() would
+        # strip it from the shared session under the other API threads
+        headers["Authorization"] = None
+        resp = asset._get(resp.headers["location"], stream=True, headers=headers)
+    if not asset._boolean(resp, 200, 404):
+        return False
+    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        fh.write(chunk)
+    return True
+
+
 def update_releases(repo, root_dir, scrub=False):
     valid_paths = BloomSet()
     releases_dir = make_dir_path(root_dir, "releases")
@@ -274,38 +407,80 @@ def update_releases(repo, root_dir, scrub=False):
 
         # Metadata
         info = {
-            "created_at": timestamp_str(release.created_at),
+            "created_at": release.created_at,
             "description": release.body,
             "draft": release.draft,
             "name": release.name,
-            "published_at": timestamp_str(release.published_at),
+            "published_at": release.published_at,
             "tag_name": release.tag_name,
         }
         metadata_path = os.path.join(release_dir, "info.json")
-        write_json(metadata_path, info)
+        asset_dir = os.path.join(release_dir, "assets")
+        asset_paths = [os.path.join(asset_dir, asset.name) for asset in release.assets]
         valid_paths.add(metadata_path)
+        for asset_path in asset_paths:
+            valid_paths.add(asset_path)
+
+        # Releases have no updated_at, so fingerprint everything we store
+        # and skip the release if none of it has changed since last time
+        release_attrs = CachedXAttrs(release_dir)
+        fingerprint = hashlib.sha256(
+            json_encoder.encode(
+                [
+                    info,
+                    [
+                        [
+                            asset.name,
+                            asset.size,
+                            asset.updated_at,
+                            asset.content_type,
+                        ]
+                        for asset in release.assets
+                    ],
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        if not scrub and release_attrs.get(ATTR_RELEASE_FINGERPRINT) == fingerprint:
+            continue
+
+        write_json(metadata_path, info)
 
         # Assets
-        asset_dir = os.path.join(release_dir, "assets")
-        for asset in release.assets:
+        if asset_paths:
             make_dir_path(asset_dir)
-            asset_path = os.path.join(asset_dir, asset.name)
+        complete = True
+        for asset, asset_path in zip(release.assets, asset_paths):
             mtime = datetime_to_time_t(asset.updated_at)
-            valid_paths.add(asset_path)
 
-            with contextlib.suppress(OSError):
+            try:
                 st = os.stat(asset_path)
+            except OSError:
+                pass
+            else:
                 if not scrub and st.st_mtime == mtime and st.st_size == asset.size:
                     continue
 
-            with UpdateFile(asset_path) as fh:
-                asset.download(fh)
+            # Assets can be large and won't be read again during this run
+            with UpdateFile(asset_path, nocache=True, size=asset.size) as fh:
+                downloaded = download_asset(asset, fh)
+                if not downloaded:
+                    # Keep whatever we had rather than an empty file
+                    fh.abort()
+            if not downloaded:
+                # Leave the fingerprint alone so the next run retries
+                complete = False
+                continue
             if fh.modified:
-                print("f", asset_path)
-            if os.stat(asset_path).st_mtime != mtime:
+                _log("f", asset_path)
+                # Otherwise the file is untouched and st is still valid
+                st = os.stat(asset_path)
+            if st.st_mtime != mtime:
                 os.utime(asset_path, (mtime, mtime))
             XAttrs(asset_path).update(ATTR_CONTENT_TYPE, asset.content_type)
 
+        if complete:
+            release_attrs.update(ATTR_RELEASE_FINGERPRINT, fingerprint)
+
     # Collect garbage, if anything has changed
     if not release_iter.skipped:
         gc_directory_tree(releases_dir, valid_paths, gc_report)
@@ -324,46 +499,70 @@ def sync_repo(repo, root_dir, token, scrub=False, git_path=None):
     }
     write_json(os.path.join(root_dir, "info.json"), info)
 
-    # Git
-    update_git(
-        repo.clone_url,
-        os.path.join(root_dir, "repo"),
-        token,
-        scrub=scrub,
-        git_path=git_path,
-    )
-    if repo.has_wiki:
-        # The wiki repo doesn't necessarily exist, even though the API
-        # claims it does.  Ignore errors during initial clone.
+    # The API metadata and the wiki don't depend on the repository mirror,
+    # so fetch them while git is running
+    with ThreadPoolExecutor(4) as executor:
+        futures = []
+        # Issues
+        if repo.has_issues:
+            futures.append(executor.submit(update_issues, repo, root_dir, scrub))
+        # Commit comments
+        futures.append(executor.submit(update_comments, repo, root_dir, scrub))
+        # Releases
+        futures.append(executor.submit(update_releases, repo, root_dir, scrub))
+
+        # Wiki.  The wiki repo doesn't necessarily exist, even though the
+        # API claims it does.  Ignore errors during initial clone.
+        if repo.has_wiki:
+            futures.append(
+                executor.submit(
+                    update_git,
+                    re.sub(r"\.git$", ".wiki", repo.clone_url),
+                    os.path.join(root_dir, "wiki"),
+                    token,
+                    scrub=scrub,
+                    ignore_clone_errors=True,
+                    git_path=git_path,
+                )
+            )
+
+        # Git
         update_git(
-            re.sub(r"\.git$", ".wiki", repo.clone_url),
-            os.path.join(root_dir, "wiki"),
+            repo.clone_url,
+            os.path.join(root_dir, "repo"),
             token,
             scrub=scrub,
-            ignore_clone_errors=True,
             git_path=git_path,
         )
 
-    # Issues
-    if repo.has_issues:
-        update_issues(repo, root_dir, scrub=scrub)
-
-    # Commit comments
-    update_comments(repo, root_dir, scrub=scrub)
-
-    # Releases
-    update_releases(repo, root_dir, scrub=scrub)
+        # Raise any exceptions
+        for future in futures:
+            future.result()
 
 
 def sync_org(org, root_dir):
     make_dir_path(root_dir)
 
-    teams = {}
-    for team in org.iter_teams():
-        teams[team.name] = {
-            "permission": team.permission,
-            "members": [u.login for u in team.iter_members()],
-            "repos": [r.name for r in team.iter_repos()],
+    def get_members(team):
+        return [u.login for u in team.iter_members()]
+
+    def get_repos(team):
+        return [r.name for r in team.iter_repos()]
+
+    # Each team needs two more paginated requests, independent of each
+    # other and of other teams; overlap all of their latency
+    with ThreadPoolExecutor(API_THREADS) as executor:
+        pending = [
+            (team, executor.submit(get_members, team), executor.submit(get_repos, team))
+            for team in org.iter_teams()
+        ]
+        teams = {
+            team.name: {
+                "permission": team.permission,
+                "members": members.result(),
+                "repos": repos.result(),
+            }
+            for team, members, repos in pending
         }
     write_json(os.path.join(root_dir, "teams.json"), teams)
 
@@ -371,6 +570,25 @@ def sync_org(org, root_dir):
 def github_login(*args, **kwargs):
     gh = github3.login(*args, **kwargs)
     gh.set_user_agent(USER_AGENT)
+    # Keep enough idle connections that concurrent requests don't each
+    # pay for a new TLS handshake, and ride out transient server errors
+    # rather than failing the whole unit
+    adapter = HTTPAdapter(
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=0.3,
+            # 429 is GitHub's secondary rate limit; Retry handles its
+            # Retry-After header
+            status_forcelist=(429, 502, 503, 504),
+            raise_on_status=False,
+        ),
+    )
+    gh._session.mount("https://", adapter)
+    # The API threads and sync_repo() tasks all share this session.  That
+    # is safe as long as nothing mutates it after login: requests.Session
+    # only reads its headers and auth while sending, and the adapter's
+    # urllib3 pool is thread-safe.
     return gh
 
 
@@ -444,8 +662,7 @@ def backup(config, scrub, organization, repo):
     print(gh.ratelimit_remaining, "requests left in quota")
 
 
-def list_repos(settings, organization):
-    gh = github_login(token=settings["github-token"])
+def list_repos(gh, organization):
     org = gh.organization(organization)
     return sorted(org.iter_repos(), key=lambda r: r.name.lower())
 
@@ -456,7 +673,8 @@ def list_repos(settings, organization):
 def ls(config, organization):
     """list repositories in the specified GitHub organization"""
     settings = config["settings"]
-    for repo in list_repos(settings, organization):
+    gh = github_login(token=settings["github-token"])
+    for repo in list_repos(gh, organization):
         print(repo.name)
 
 
@@ -473,14 +691,21 @@ class GitHubUnit(Unit):
 
 class GitHubSource(Source):
     LABEL = "github"
+    # Repository backups are bound by network latency rather than local
+    # resources, so run several at once by default
+    DEFAULT_WORKERS = 4
 
     def get_units(self):
-        ret = []
+        ret: List[Unit] = []
+        if not self._manifest:
+            return ret
+        # Share one session, and its connection pool, across organizations
+        gh = github_login(token=self._settings["github-token"])
         for org, info in self._manifest.items():
             info = info or {}
 
             # obtain list of repos
-            repos = list_repos(self._settings, org)
+            repos = list_repos(gh, org)
 
             # Update org metadata
             if info.get("organization-metadata", True):
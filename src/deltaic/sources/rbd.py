@@ -19,46 +19,108 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import collections
 import contextlib
+import functools
+import io
 import json
 import os
+import re
+import shutil
 import struct
 import subprocess
 import sys
 import uuid
-from typing import BinaryIO
+from typing import BinaryIO, Deque, Tuple, cast
 
 import click
 
 from ..command import pass_config
 from ..platform import punch
-from ..util import XAttrs, make_dir_path, random_do_work
+from ..util import XAttrs, make_dir_path, prefetch_iter, random_do_work
 from . import Source, Unit
 
 BLOCKSIZE = 256 << 10
+# Blocks written before we retry dropping them from the page cache
+CACHE_DROP_LAG = 64
+ZERO_BLOCK = bytes(BLOCKSIZE)
 DIFF_MAGIC = b"rbd diff v1\n"
 PENDING_EXT = ".pending"
 ATTR_SNAPSHOT = "user.rbd.snapshot"
 ATTR_PENDING_SNAPSHOT = "user.rbd.pending-snapshot"
 ATTR_SNAPID = "user.rbd.snapid"
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+DIFF_U32 = struct.Struct("<I")
+DIFF_U64 = struct.Struct("<Q")
+DIFF_EXTENT = struct.Struct("<QQ")
+DIFF_QUEUE_DEPTH = 16
+# prefetch_iter() holds up to DIFF_QUEUE_DEPTH queued records, plus the one
+# being consumed and the one being produced
+DIFF_BUFFERS = DIFF_QUEUE_DEPTH + 2
+
+
+# We drive the rbd CLI rather than the librados/librbd Python bindings,
+# which would let one cluster connection serve every operation on an image.
+# The bindings ship with Ceph rather than PyPI and have to match the
+# installed librados, so they can't be a dependency of this package.
+
+
+@functools.lru_cache(maxsize=None)
+def rbd_spawn_args():
+    # A backup makes several short rbd calls.  Given an absolute executable
+    # and close_fds=False, Python 3.8 and 3.9 start them with posix_spawn()
+    # rather than fork(); newer versions use vfork() in any case.  Our own
+    # descriptors are non-inheritable, so they still don't leak.
+    return {"executable": shutil.which("rbd") or "rbd", "close_fds": False}
 
 
 def rbd_exec(pool, cmd, *args):
     cmdline = ["rbd", cmd] + list(args) + ["-p", pool]
     print(" ".join(cmdline))
-    subprocess.run(cmdline, check=True)
+    subprocess.run(cmdline, check=True, **rbd_spawn_args())
 
 
-def rbd_query(pool, *args):
+def rbd_query_output(pool, *args):
     cmd = ["rbd"] + list(args) + ["-p", pool, "--format=json"]
-    ret = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        encoding=sys.stdout.encoding,
-    )
+    ret = subprocess.run(cmd, stdout=subprocess.PIPE, **rbd_spawn_args())
     if ret.returncode != 0:
         raise OSError(f"rbd query returned {ret.returncode}")
-    return json.loads(ret.stdout)
+    return ret.stdout
+
+
+def rbd_query(pool, *args):
+    # json.loads() decodes UTF-8 itself; skip building an intermediate str
+    return json.loads(rbd_query_output(pool, *args))
+
+
+def _skip_ws(data, idx):
+    match = JSON_WHITESPACE.match(data, idx)
+    # The pattern matches the empty string, so it can't fail
+    assert match is not None
+    return match.end()
+
+
+def rbd_query_iter(pool, *args):
+    """Like rbd_query() for queries returning a JSON array, but decode the
+    elements one at a time, so a caller searching for one entry can stop
+    without decoding the rest."""
+    data = rbd_query_output(pool, *args).decode("utf-8")
+    decoder = json.JSONDecoder()
+    idx = _skip_ws(data, 0)
+    if data[idx : idx + 1] != "[":
+        raise ValueError("rbd query didn't return an array")
+    idx = _skip_ws(data, idx + 1)
+    if data[idx : idx + 1] == "]":
+        return
+    while True:
+        item, idx = decoder.raw_decode(data, idx)
+        yield item
+        idx = _skip_ws(data, idx)
+        if data[idx : idx + 1] == "]":
+            return
+        if data[idx : idx + 1] != ",":
+            raise ValueError("Malformed JSON array from rbd query")
+        idx = _skip_ws(data, idx + 1)
 
 
 def rbd_pool_info(pool):
@@ -66,11 +128,15 @@ def rbd_pool_info(pool):
 
 
 def rbd_list_snapshots(pool, image):
-    return rbd_query(pool, "snap", "ls", "-l", image)
+    return rbd_query_iter(pool, "snap", "ls", "-l", image)
 
 
-def get_image_for_snapshot(pool, snapshot):
-    for cur in rbd_pool_info(pool):
+def get_image_for_snapshot(pool, snapshot, pool_info=None):
+    # Callers looking up several snapshots can pass in one rbd_pool_info()
+    # result rather than listing the pool each time
+    if pool_info is None:
+        pool_info = rbd_query_iter(pool, "ls", "-l")
+    for cur in pool_info:
         if cur.get("snapshot") == snapshot:
             return cur["image"]
     raise KeyError(f"Couldn't locate snapshot {snapshot}")
@@ -101,6 +167,8 @@ def try_unlink(path):
 class LazyWriteFile:
     def __init__(self, path, create=False):
         self._path = path
+        # Recently written extents, whose pages may still be dirty
+        self._written: Deque[Tuple[int, int]] = collections.deque()
         if create and not os.path.exists(path):
             fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
             self._fh: BinaryIO = os.fdopen(fd, "r+b")
@@ -144,6 +212,25 @@ class LazyWriteFile:
         self.__reopen_rw__()
         self._fh.writelines(seq)
 
+    def pwrite(self, buf, offset):
+        # Write at offset with one syscall, bypassing the buffered file
+        # and its seek() flush.  Doesn't move the file position.
+        self.__reopen_rw__()
+        fd = self._fh.fileno()
+        extent = (offset, len(buf))
+        while buf:
+            count = os.pwrite(fd, buf, offset)
+            buf = buf[count:]
+            offset += count
+        # The image won't be read back during this backup, so keep it from
+        # displacing other data in the page cache.  Dirty pages can't be
+        # dropped, so this just starts writeback; drop the extent for real
+        # once it has had some time to reach the disk.
+        os.posix_fadvise(fd, *extent, os.POSIX_FADV_DONTNEED)
+        self._written.append(extent)
+        if len(self._written) > CACHE_DROP_LAG:
+            os.posix_fadvise(fd, *self._written.popleft(), os.POSIX_FADV_DONTNEED)
+
     def truncate(self, len):
         saved_offset = self._fh.tell()
         self._fh.seek(0, 2)
@@ -155,6 +242,9 @@ class LazyWriteFile:
             self._fh.truncate(len)
 
     def close(self):
+        if self._written and not self._fh.closed:
+            os.posix_fadvise(self._fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            self._written.clear()
         self._fh.close()
 
     @property
@@ -174,12 +264,24 @@ class ScrubbingFile(LazyWriteFile):
 
     def __init__(self, path):
         super().__init__(path)
+        # Reused for every full block read from disk
+        self._disk_buf = bytearray(BLOCKSIZE)
 
     def write(self, buf):
         start = 0
         while start < len(buf):
-            disk_buf = self._fh.read(min(BLOCKSIZE, len(buf) - start))
-            count = len(disk_buf)
+            offset = self._fh.tell()
+            size = min(BLOCKSIZE, len(buf) - start)
+            disk_buf = self._disk_buf if size == BLOCKSIZE else bytearray(size)
+            # BinaryIO lacks readinto(), but _fh is always a buffered file
+            count = cast(io.BufferedRandom, self._fh).readinto(disk_buf)
+            if count != size:
+                disk_buf = disk_buf[:count]
+            # We won't need these pages again
+            os.posix_fadvise(self._fh.fileno(), offset, count, os.POSIX_FADV_DONTNEED)
+            # unpack_diff() passes memoryviews.  Comparing one against
+            # bytes goes item by item, but a bytearray compares with
+            # memcmp() against any buffer.
             input_buf = buf[start : start + count]
             if disk_buf != input_buf:
                 self._fh.seek(-count, 1)
@@ -187,13 +289,24 @@ class ScrubbingFile(LazyWriteFile):
                 super().write(input_buf)
             start += count
 
+    def pwrite(self, buf, offset):
+        self._fh.seek(offset)
+        self.write(buf)
+
     def punch(self, offset, length):
         # deltaic.platform.punch will call this.
         if "+" not in self._fh.mode:
+            # Check block by block, stopping at the first nonzero block,
+            # rather than reading the whole extent into memory
             self._fh.seek(offset)
-            buf = self._fh.read(length)
-            bufsize = len(buf)
-            if bufsize == length and bufsize == buf.count(b"\0"):
+            remaining = length
+            while remaining > 0:
+                count = min(remaining, BLOCKSIZE)
+                zero = ZERO_BLOCK if count == BLOCKSIZE else bytes(count)
+                if self._fh.read(count) != zero:
+                    break
+                remaining -= count
+            else:
                 return
         super().punch(offset, length)
 
@@ -213,57 +326,91 @@ def export_diff(pool, image, snapshot, basis=None, fh=subprocess.PIPE):
     if basis is not None:
         cmd.extend(["--from-snap", basis])
     print(" ".join(cmd))
-    return subprocess.Popen(cmd, stdout=fh)
+    return subprocess.Popen(cmd, stdout=fh, **rbd_spawn_args())
 
 
 def read_items(fh, fmt):
-    size = struct.calcsize(fmt)
-    buf = fh.read(size)
-    items = struct.unpack(fmt, buf)
+    # fmt is a precompiled struct.Struct
+    items = fmt.unpack(fh.read(fmt.size))
     if len(items) == 1:
         return items[0]
     else:
         return items
 
 
-def unpack_diff(ifh, ofh, verbose=True):
-    total_size = 0
-    total_changed = 0
+def read_diff(ifh):
+    """Parse an rbd diff stream, yielding (b"s", size), (b"w", offset, data)
+    and (b"z", offset, length) records.  Data extents are split into
+    blocks of at most BLOCKSIZE.  data is a view into a ring of reusable
+    buffers, valid until DIFF_BUFFERS more blocks have been yielded.
+    Abutting zero extents are merged, so they can be punched at once."""
+    buffers = [memoryview(bytearray(BLOCKSIZE)) for _ in range(DIFF_BUFFERS)]
+    next_buffer = 0
+    zero_offset = zero_length = 0
     # Read header
     buf = ifh.read(len(DIFF_MAGIC))
     if buf != DIFF_MAGIC:
         raise OSError("Missing diff magic string")
     # Read each record
     while True:
-        type = read_items(ifh, "c")
+        type = ifh.read(1)
+        if zero_length and type != b"z":
+            yield b"z", zero_offset, zero_length
+            zero_length = 0
         if type in (b"f", b"t"):
             # Source/dest snapshot name => ignore
-            size = read_items(ifh, "<I")
+            size = read_items(ifh, DIFF_U32)
             ifh.read(size)
         elif type == b"s":
             # Image size
-            total_size = read_items(ifh, "<Q")
-            ofh.truncate(total_size)
+            yield type, read_items(ifh, DIFF_U64)
         elif type == b"w":
             # Data
-            offset, length = read_items(ifh, "<QQ")
-            total_changed += length
-            ofh.seek(offset)
+            offset, length = read_items(ifh, DIFF_EXTENT)
             while length > 0:
-                buf = ifh.read(min(length, BLOCKSIZE))
-                ofh.write(buf)
-                length -= len(buf)
+                view = buffers[next_buffer]
+                next_buffer = (next_buffer + 1) % DIFF_BUFFERS
+                count = ifh.readinto(view[: min(length, BLOCKSIZE)])
+                if not count:
+                    raise OSError("Unexpected EOF in diff data")
+                yield type, offset, view[:count]
+                offset += count
+                length -= count
         elif type == b"z":
             # Zero data
-            offset, length = read_items(ifh, "<QQ")
-            total_changed += length
-            punch(ofh, offset, length)
+            offset, length = read_items(ifh, DIFF_EXTENT)
+            if zero_length and zero_offset + zero_length == offset:
+                zero_length += length
+            else:
+                if zero_length:
+                    yield type, zero_offset, zero_length
+                zero_offset, zero_length = offset, length
         elif type == b"e":
             if ifh.read(1) != b"":
                 raise OSError("Expected EOF, didn't find it")
             break
         else:
             raise ValueError(f"Unknown record type: {type}")
+
+
+def unpack_diff(ifh, ofh, verbose=True):
+    total_size = 0
+    total_changed = 0
+    # Parse the diff in another thread, so reading from rbd overlaps with
+    # writing (or, when scrubbing, reading and comparing) the image
+    for record in prefetch_iter(read_diff(ifh), DIFF_QUEUE_DEPTH):
+        type = record[0]
+        if type == b"s":
+            total_size = record[1]
+            ofh.truncate(total_size)
+        elif type == b"w":
+            _, offset, data = record
+            ofh.pwrite(data, offset)
+            total_changed += len(data)
+        elif type == b"z":
+            _, offset, length = record
+            total_changed += length
+            punch(ofh, offset, length)
     if verbose:
         print(f"{total_changed} bytes written, {total_size} total")
 
@@ -271,15 +418,13 @@ def unpack_diff(ifh, ofh, verbose=True):
 def fetch_snapshot(pool, image, snapshot, path):
     if os.path.exists(path):
         os.unlink(path)
-    proc = export_diff(pool, image, snapshot)
     try:
-        with LazyWriteFile(path, create=True) as ofh:
-            unpack_diff(proc.stdout, ofh)
-        if proc.wait():
-            raise OSError(f"Export returned {proc.returncode}")
+        # A full export needs no diff parsing.  Have rbd write the sparse
+        # image file itself, rather than piping every byte through us.
+        rbd_exec(pool, "export", "--no-progress", "--snap", snapshot, image, path)
         XAttrs(path).update(ATTR_SNAPSHOT, snapshot)
     except Exception:
-        os.unlink(path)
+        try_unlink(path)
         raise
 
 
@@ -342,11 +487,16 @@ def apply_patch_and_rebase(pool, image, path):
 def backup_image(pool, image, path):
     old_snapshot = XAttrs(path).get(ATTR_SNAPSHOT)
     if old_snapshot is not None:
-        # Check for common base image
+        # Check for common base image.  Usually the snapshot is still on
+        # this image, which we can confirm without listing the whole pool.
         try:
-            old_image = get_image_for_snapshot(pool, old_snapshot)
-        except KeyError:
-            old_image = None
+            get_snapid_for_snapshot(pool, image, old_snapshot)
+            old_image = image
+        except (KeyError, OSError):
+            try:
+                old_image = get_image_for_snapshot(pool, old_snapshot)
+            except KeyError:
+                old_image = None
         if image != old_image:
             # Base image has changed
             if old_image is not None:
@@ -372,11 +522,12 @@ def backup_snapshot(pool, snapshot, path):
     snapid = get_snapid_for_snapshot(pool, image, snapshot)
     attrs = XAttrs(path)
     if str(snapid) == attrs.get(ATTR_SNAPID):
-        return
+        return image
     # Okay, snapshot has changed.  Delete the current backup and start over.
     # (Inefficient, but we assume this doesn't happen very often.)
     fetch_snapshot(pool, image, snapshot, path)
     attrs.update(ATTR_SNAPID, str(snapid))
+    return image
 
 
 def restore_image(path, pool, image):
@@ -396,11 +547,14 @@ def drop_image_snapshots(pool, path):
     if not os.path.exists(path):
         return
     attrs = XAttrs(path)
+    pool_info = None
     for attr in ATTR_SNAPSHOT, ATTR_PENDING_SNAPSHOT:
         snapshot = attrs.get(attr)
         if snapshot:
             try:
-                image = get_image_for_snapshot(pool, snapshot)
+                if pool_info is None:
+                    pool_info = rbd_pool_info(pool)
+                image = get_image_for_snapshot(pool, snapshot, pool_info)
                 delete_snapshot(pool, image, snapshot)
             except (KeyError, subprocess.CalledProcessError):
                 pass
@@ -441,9 +595,8 @@ def backup(config, scrub, snapshot, pool, friendly_name):
     )
     make_dir_path(os.path.dirname(out_path))
     if snapshot:
-        backup_snapshot(pool, object_name, out_path)
+        image = backup_snapshot(pool, object_name, out_path)
         if scrub:
-            image = get_image_for_snapshot(pool, object_name)
             scrub_snapshot(pool, image, object_name, out_path)
     else:
         backup_image(pool, object_name, out_path)
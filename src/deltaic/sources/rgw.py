@@ -19,16 +19,22 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import atexit
+import calendar
 import contextlib
+import functools
 import json
 import os
+import re
 import subprocess
 import sys
+import threading
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Union
 
 import boto
 import click
@@ -38,9 +44,12 @@ from boto.s3.connection import OrdinaryCallingFormat
 from ..command import pass_config
 from ..util import (
     BloomSet,
+    DigestSet,
+    LogSink,
     UpdateFile,
     datetime_to_time_t,
     make_dir_path,
+    merge_iters,
     random_do_work,
     update_file,
 )
@@ -56,6 +65,10 @@ KEY_METADATA_ATTRS = {
     "last_modified": "Last-Modified",
 }
 
+# Shared by every key's metadata; json.dumps() would build a new encoder
+# per call.  Output is the same as json.dumps(obj, sort_keys=True).
+json_encoder = json.JSONEncoder(sort_keys=True)
+
 KEY_UPLOAD_HEADERS = {
     "cache-control",
     "content-disposition",
@@ -64,8 +77,47 @@ KEY_UPLOAD_HEADERS = {
     "content-type",
 }
 
+# Per-key progress output is buffered; see LogSink
+_log_sink = LogSink()
+atexit.register(_log_sink.flush)
+_log = _log_sink.log
+
 S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
 
+# Last-Modified as found in bucket listings, e.g. 2013-03-09T19:38:27.000Z
+S3_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?Z$")
+
+# boto moves key data in Key.BufferSize pieces, 8 KiB by default, with a
+# Python-level read and write for each
+KEY_BUFFER_SIZE = 1 << 20
+
+# Restores upload keys at least this large first, biggest first, so that
+# a few large keys don't leave the other workers idle at the end
+RESTORE_LARGE_KEY = 64 << 20
+
+# Restores upload keys at least this large in parts, each retried on its
+# own.  A single PUT is also limited to 5 GiB.
+UPLOAD_MULTIPART_THRESHOLD = 256 << 20
+UPLOAD_PART_SIZE = 64 << 20
+UPLOAD_MAX_PARTS = 10000
+
+# Keys handed to a pool worker per round trip.  Most keys in an
+# incremental backup need only a stat(), so per-key dispatch would be
+# dominated by IPC; larger chunks would leave workers idle at the end.
+SYNC_CHUNK_SIZE = 16
+
+# Key names splitting the bucket listing into ranges which are listed
+# concurrently.  Listing is otherwise one round trip per thousand keys,
+# and in an incremental backup most keys need only a stat().  The
+# ranges are contiguous, so every key falls in one of them however
+# the bucket's names are distributed.
+LIST_SHARD_BOUNDARIES = "048AEIMQUaeimqu"
+
+# Keys queued to the sync pool per worker.  Pool reads its input
+# iterator as fast as it can, so without a bound a large bucket's whole
+# listing would be queued in memory ahead of the workers.
+SYNC_QUEUE_CHUNKS = 4
+
 SCRUB_NONE = 0
 SCRUB_ACLS = 1
 SCRUB_ALL = 2
@@ -82,9 +134,13 @@ def radosgw_admin(*args):
     return json.loads(ret.stdout)
 
 
-def get_bucket_credentials(bucket_name):
-    info = radosgw_admin("bucket", "stats", "--bucket", bucket_name)
-    return get_user_credentials(info["owner"])
+def get_bucket_stats(bucket_name):
+    return radosgw_admin("bucket", "stats", "--bucket", bucket_name)
+
+
+def get_bucket_key_count(stats):
+    # Summed over storage categories such as "rgw.main"
+    return sum(u.get("num_objects", 0) for u in stats.get("usage", {}).values())
 
 
 def get_user_credentials(userid):
@@ -108,42 +164,124 @@ def add_type_code(path, code):
 
 
 def split_type_code(path):
-    if path[-2] != "_":
+    if len(path) < 2 or path[-2] != "_":
         raise ValueError(f"Path has no type code: {path}")
     return path[:-2], path[-1]
 
 
-def key_name_to_path(root_dir, key_name, type_code):
+def parse_key_date(key_date):
+    # Called for every key, so avoid dateutil's general-purpose parser
+    # when the date has the usual fixed format
+    match = S3_DATE.match(key_date)
+    if match is None:
+        return datetime_to_time_t(dateutil.parser.parse(key_date))
+    return calendar.timegm(tuple(int(v) for v in match.groups()))
+
+
+def key_name_to_base(root_dir, key_name):
+    # Path for key_name without its type code, to which callers needing
+    # several of the key's files can append each code cheaply
     rel_dirpath, filename = os.path.split(key_name)
     # Don't rewrite root directory to "_d"
     if rel_dirpath:
-        rel_dirpath = "/".join([add_type_code(n, "d") for n in rel_dirpath.split("/")])
-    filename = add_type_code(filename, type_code)
+        rel_dirpath = encode_key_dir(rel_dirpath)
     return os.path.join(root_dir, rel_dirpath, filename)
 
 
-def path_to_key_name(root_dir, path):
-    relpath = os.path.relpath(path, root_dir)
-    components_in = relpath.split("/")
-    components_out = []
-    for component in components_in[:-1]:
+# Keys are mostly listed in order, so siblings sharing a directory arrive
+# together
+@functools.lru_cache(maxsize=4096)
+def encode_key_dir(rel_dirpath):
+    return "/".join([add_type_code(n, "d") for n in rel_dirpath.split("/")])
+
+
+def key_name_to_path(root_dir, key_name, type_code):
+    return add_type_code(key_name_to_base(root_dir, key_name), type_code)
+
+
+def dir_to_key_prefix(root_dir, dirpath):
+    # Key name prefix, including the trailing slash, for keys stored in
+    # dirpath.  Walkers compute this once per directory rather than
+    # calling path_to_key_name() for every file.
+    relpath = os.path.relpath(dirpath, root_dir)
+    if relpath == ".":
+        return ""
+    components = []
+    for component in relpath.split("/"):
         component, code = split_type_code(component)
         if code != "d":
             raise ValueError(f"Path element missing directory type code: {component}")
-        components_out.append(component)
-    component, _ = split_type_code(components_in[-1])
-    components_out.append(component)
-    return "/".join(components_out)
+        components.append(component)
+    return "/".join(components) + "/"
 
 
-def enumerate_keys(bucket):
-    names = BloomSet()
+def path_to_key_name(root_dir, path):
+    dirpath, filename = os.path.split(path)
+    name, _ = split_type_code(filename)
+    return dir_to_key_prefix(root_dir, dirpath) + name
 
-    def iter():
-        for key in bucket.list():
-            names.add(key.name)
+
+def scan_dir(dirpath, onerror):
+    # Return the paths of dirpath's subdirectories and the DirEntry objects
+    # of everything else.  As in os.walk(), symlinks to directories are
+    # neither.
+    try:
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+    except OSError as e:
+        onerror(e)
+        return [], []
+    subdirs = []
+    others = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            others.append(entry)
+        elif not entry.is_symlink():
+            subdirs.append(entry.path)
+    return subdirs, others
+
+
+def scan_tree(top, onerror):
+    # Like os.walk(top, topdown=False), but yielding DirEntry objects so
+    # callers don't have to rebuild the paths
+    subdirs, entries = scan_dir(top, onerror)
+    for subdir in subdirs:
+        yield from scan_tree(subdir, onerror)
+    yield top, entries
+
+
+def enumerate_keys(open_bucket, expected_keys=0, bloom_gc=False):
+    # Track key names exactly unless the bucket is too large for that
+    names: Union[BloomSet, DigestSet]
+    if not bloom_gc:
+        names = DigestSet()
+    elif expected_keys:
+        # Sized to hold the whole bucket in one filter, plus room for keys
+        # created since the count was taken
+        names = BloomSet(initial_capacity=expected_keys + expected_keys // 8)
+    else:
+        names = BloomSet()
+
+    def list_range(after, last):
+        # boto connections aren't thread-safe, so each range gets its own
+        bucket = open_bucket()
+        for key in bucket.list(marker=after):
+            if last is not None and key.name > last:
+                break
             yield (key.name, key.size, key.last_modified)
 
+    def iter():
+        # S3 lists keys strictly after the marker
+        starts = [""] + list(LIST_SHARD_BOUNDARIES)
+        ends: List[Optional[str]] = [*LIST_SHARD_BOUNDARIES, None]
+        for item in merge_iters(list_range(*r) for r in zip(starts, ends)):
+            names.add(item[0])
+            yield item
+
     return iter(), names
 
 
@@ -152,15 +290,17 @@ def enumerate_keys_from_directory(root_dir):
         raise err
 
     for dirpath, _, filenames in os.walk(root_dir, onerror=handle_err):
+        prefix = None
         for filename in sorted(filenames):
-            filepath = os.path.join(dirpath, filename)
             try:
-                _, code = split_type_code(filepath)
+                name, code = split_type_code(filename)
             except ValueError:
                 continue
             if code != "k":
                 continue
-            yield path_to_key_name(root_dir, filepath)
+            if prefix is None:
+                prefix = dir_to_key_prefix(root_dir, dirpath)
+            yield prefix + name
 
 
 root_dir: Optional[Path] = None
@@ -175,16 +315,24 @@ def sync_pool_init(
     root_dir = Path(root_dir_)
     scrub = scrub_
     conn = connect(server, access_key, secret_key, secure=secure)
-    download_bucket = conn.get_bucket(bucket_name)
+    # The parent has already validated the bucket; don't spend another
+    # round trip per worker doing so
+    download_bucket = conn.get_bucket(bucket_name, validate=False)
+
+
+def read_key_etag(meta_path):
+    try:
+        with open(meta_path, "rb") as fh:
+            return json.load(fh).get("ETag")
+    except (OSError, ValueError):
+        return None
 
 
 def sync_key(args):
     key_name, key_size, key_date = args
-    key_time = datetime_to_time_t(dateutil.parser.parse(key_date))
-    out_data = key_name_to_path(root_dir, key_name, "k")
-    out_meta = key_name_to_path(root_dir, key_name, "m")
-    out_acl = key_name_to_path(root_dir, key_name, "a")
-    out_dir = os.path.dirname(out_data)
+    key_time = parse_key_date(key_date)
+    out_base = key_name_to_base(root_dir, key_name)
+    out_data = add_type_code(out_base, "k")
 
     try:
         st = os.stat(out_data)
@@ -192,23 +340,50 @@ def sync_key(args):
             scrub == SCRUB_ALL or st.st_size != key_size or st.st_mtime != key_time
         )
     except OSError:
+        st = None
         update_data = True
 
+    # Most keys in an incremental backup stop here, so only build the
+    # other paths once we know we need them
     if not update_data and scrub == SCRUB_NONE:
         return (None, None)
 
-    make_dir_path(out_dir)
+    out_meta = add_type_code(out_base, "m")
+    out_acl = add_type_code(out_base, "a")
+    if st is None:
+        # Otherwise the directory evidently exists already
+        make_dir_path(os.path.dirname(out_data))
 
     # should have been set by pool initializer
     assert download_bucket is not None
 
     key = download_bucket.new_key(key_name)
+    key.BufferSize = KEY_BUFFER_SIZE
     updated = False
     try:
         if update_data:
-            with UpdateFile(out_data, suffix="_t") as fh:
-                key.get_contents_to_file(fh)
-            updated |= fh.modified
+            headers = None
+            if scrub != SCRUB_ALL and st is not None and st.st_size == key_size:
+                # Only the mtime differs.  If the key was rewritten with the
+                # same contents, let the server tell us so rather than
+                # sending them again.
+                etag = read_key_etag(out_meta)
+                if etag:
+                    headers = {"If-None-Match": etag}
+            try:
+                with UpdateFile(
+                    out_data, suffix="_t", nocache=True, size=key_size
+                ) as fh:
+                    key.get_contents_to_file(fh, headers=headers)
+                data_modified = fh.modified
+            except boto.exception.S3ResponseError as e:
+                if headers is None or e.status != 304:
+                    raise
+                data_modified = False
+                # Fetch the current metadata, which a 304 may not include
+                key = download_bucket.get_key(key_name)
+                if key is None:
+                    raise OSError("Key disappeared")
             metadata = {
                 "metadata": key.metadata,
             }
@@ -216,13 +391,15 @@ def sync_key(args):
                 value = getattr(key, attr, None)
                 if value:
                     metadata[name] = value
-            updated |= update_file(
-                out_meta, json.dumps(metadata, sort_keys=True), suffix="_t"
+            meta_modified = update_file(
+                out_meta, json_encoder.encode(metadata), suffix="_t"
             )
+            updated |= data_modified or meta_modified
         updated |= update_file(out_acl, key.get_xml_acl(), suffix="_t")
         if update_data:
-            for path in out_data, out_meta:
-                if os.stat(path).st_mtime != key_time:
+            for path, modified in (out_data, data_modified), (out_meta, meta_modified):
+                # A file we just replaced can't have the right mtime yet
+                if modified or os.stat(path).st_mtime != key_time:
                     os.utime(path, (key_time, key_time))
             # Don't utimes out_acl, since the Last-Modified time doesn't
             # apply to it
@@ -240,34 +417,63 @@ def sync_key(args):
         return (key_name, f"Couldn't fetch {key_name}: {e}")
 
 
-def sync_bucket(server, bucket_name, root_dir, workers, scrub, secure):
+def sync_bucket(server, bucket_name, root_dir, workers, scrub, secure, bloom_gc=False):
     warned = set()
+    output_lock = threading.Lock()
 
     def warn(msg, *args):
-        print(msg % args, file=sys.stderr)
+        with output_lock:
+            print(msg % args, file=sys.stderr)
         warned.add(True)
 
     # Connect
-    access_key, secret_key = get_bucket_credentials(bucket_name)
+    stats = get_bucket_stats(bucket_name)
+    access_key, secret_key = get_user_credentials(stats["owner"])
     conn = connect(server, access_key, secret_key, secure=secure)
     bucket = conn.get_bucket(bucket_name)
 
+    def open_bucket():
+        conn = connect(server, access_key, secret_key, secure=secure)
+        return conn.get_bucket(bucket_name, validate=False)
+
     # Create root directory
     make_dir_path(root_dir)
 
     # Keys
     start_time = time.time()
+    in_flight = threading.Semaphore(workers * SYNC_QUEUE_CHUNKS * SYNC_CHUNK_SIZE)
+    stopping = threading.Event()
+
+    def throttle(iter):
+        # Runs in the pool's task handler thread
+        for item in iter:
+            in_flight.acquire()
+            if stopping.is_set():
+                return
+            yield item
+
     with Pool(
         workers,
         sync_pool_init,
         [root_dir, server, bucket_name, access_key, secret_key, secure, scrub],
     ) as pool:
-        iter, key_set = enumerate_keys(bucket)
-        for path, error in pool.imap_unordered(sync_key, iter):
-            if error:
-                warn(error)
-            elif path:
-                print(path)
+        iter, key_set = enumerate_keys(
+            open_bucket, get_bucket_key_count(stats), bloom_gc=bloom_gc
+        )
+        try:
+            for path, error in pool.imap_unordered(
+                sync_key, throttle(iter), chunksize=SYNC_CHUNK_SIZE
+            ):
+                in_flight.release()
+                if error:
+                    warn(error)
+                elif path:
+                    _log(path)
+        finally:
+            # Don't leave the task handler blocked if we're bailing out,
+            # or terminating the pool will wait for it forever
+            stopping.set()
+            in_flight.release()
         pool.close()
         pool.join()
 
@@ -287,11 +493,12 @@ def sync_bucket(server, bucket_name, root_dir, workers, scrub, secure):
     def handle_err(err):
         warn(f"Couldn't list directory: {err}")
 
-    for dirpath, _, filenames in os.walk(root_dir, topdown=False, onerror=handle_err):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
+    def collect_dir(dirpath, entries):
+        prefix = None
+        for entry in entries:
+            filepath = entry.path
             try:
-                _, code = split_type_code(filepath)
+                name, code = split_type_code(entry.name)
             except ValueError:
                 # Delete files without type codes
                 delete = True
@@ -303,14 +510,15 @@ def sync_bucket(server, bucket_name, root_dir, workers, scrub, secure):
                     # Leftover temporary file
                     delete = True
                 else:
-                    key_name = path_to_key_name(root_dir, filepath)
-                    delete = key_name not in key_set
-                    if delete and os.stat(filepath).st_mtime > start_time:
+                    if prefix is None:
+                        prefix = dir_to_key_prefix(root_dir, dirpath)
+                    delete = prefix + name not in key_set
+                    if delete and entry.stat().st_mtime > start_time:
                         # Probably a failure to non-destructively encode the
                         # key name in the filesystem path.
                         warn(f"Warning: Deleting file that we just created: {filepath}")
             if delete:
-                print("Deleting", filepath)
+                _log("Deleting", filepath)
                 try:
                     os.unlink(filepath)
                 except OSError as e:
@@ -319,6 +527,18 @@ def sync_bucket(server, bucket_name, root_dir, workers, scrub, secure):
         with contextlib.suppress(OSError):
             os.rmdir(dirpath)
 
+    def collect_tree(top):
+        for dirpath, entries in scan_tree(top, handle_err):
+            collect_dir(dirpath, entries)
+
+    # Subtrees of the root are independent, so walk them concurrently; the
+    # walk is mostly syscalls, which release the GIL
+    subdirs, entries = scan_dir(root_dir, handle_err)
+    with ThreadPoolExecutor(workers) as executor:
+        # Consume the results to re-raise any exceptions
+        list(executor.map(collect_tree, subdirs))
+    collect_dir(root_dir, entries)
+
     # Return True on success, False if there were warnings
     return not warned
 
@@ -339,6 +559,9 @@ def upload_pool_init(root_dir_, server, bucket_name, secure):
     upload_buckets = {}  # owner -> bucket
 
 
+# Keys in a bucket usually share a handful of distinct ACLs, so most
+# lookups needn't parse the XML at all
+@functools.lru_cache(maxsize=256)
 def get_owner_name(acl_xml):
     owner = ET.fromstring(acl_xml).find(f"{{{S3_NAMESPACE}}}Owner/{{{S3_NAMESPACE}}}ID")
     assert owner is not None
@@ -353,11 +576,29 @@ def upload_get_bucket(owner):
     return upload_buckets[owner]
 
 
+def upload_key_multipart(key, fh, size, headers):
+    part_size = max(UPLOAD_PART_SIZE, -(-size // UPLOAD_MAX_PARTS))
+    upload = key.bucket.initiate_multipart_upload(
+        key.name, headers=headers, metadata=key.metadata
+    )
+    try:
+        for part_num, offset in enumerate(range(0, size, part_size), 1):
+            fh.seek(offset)
+            upload.upload_part_from_file(
+                fh, part_num, size=min(part_size, size - offset)
+            )
+        upload.complete_upload()
+    except BaseException:
+        upload.cancel_upload()
+        raise
+
+
 def upload_key(args):
     key_name = args
-    in_data = key_name_to_path(root_dir, key_name, "k")
-    in_meta = key_name_to_path(root_dir, key_name, "m")
-    in_acl = key_name_to_path(root_dir, key_name, "a")
+    in_base = key_name_to_base(root_dir, key_name)
+    in_data = add_type_code(in_base, "k")
+    in_meta = add_type_code(in_base, "m")
+    in_acl = add_type_code(in_base, "a")
 
     key = None
     try:
@@ -365,13 +606,18 @@ def upload_key(args):
             key_acl = fh.read().decode("utf-8")
         owner = get_owner_name(key_acl)
         key = upload_get_bucket(owner).new_key(key_name)
+        key.BufferSize = KEY_BUFFER_SIZE
 
         with open(in_meta, "rb") as fh:
             meta = json.load(fh)
         key.metadata.update(meta["metadata"])
         headers = {k: v for k, v in meta.items() if k.lower() in KEY_UPLOAD_HEADERS}
         with open(in_data, "rb") as fh:
-            key.set_contents_from_file(fh, headers=headers)
+            size = os.fstat(fh.fileno()).st_size
+            if size >= UPLOAD_MULTIPART_THRESHOLD:
+                upload_key_multipart(key, fh, size, headers)
+            else:
+                key.set_contents_from_file(fh, headers=headers)
         key.set_xml_acl(key_acl)
         return (key_name, None)
     except Exception as e:
@@ -382,6 +628,24 @@ def upload_key(args):
         return (key_name, f"Couldn't upload {key_name}: {e}")
 
 
+def enumerate_keys_for_restore(root_dir):
+    # Only the large keys are held in memory; the rest are streamed from
+    # a second walk
+    large = []
+    for key_name in enumerate_keys_from_directory(root_dir):
+        size = os.stat(key_name_to_path(root_dir, key_name, "k")).st_size
+        if size >= RESTORE_LARGE_KEY:
+            large.append((size, key_name))
+    large.sort(reverse=True)
+    large_names = set()
+    for _, key_name in large:
+        large_names.add(key_name)
+        yield key_name
+    for key_name in enumerate_keys_from_directory(root_dir):
+        if key_name not in large_names:
+            yield key_name
+
+
 def restore_bucket(root_dir, server, dest_bucket_name, force, secure, workers):
     # Check for valid bucket dir
     bucket_acl_path = key_name_to_path(root_dir, "bucket", "A")
@@ -413,12 +677,12 @@ def restore_bucket(root_dir, server, dest_bucket_name, force, secure, workers):
 
     # Upload keys
     pool = Pool(workers, upload_pool_init, [root_dir, server, dest_bucket_name, secure])
-    iter = enumerate_keys_from_directory(root_dir)
+    iter = enumerate_keys_for_restore(root_dir)
     for path, error in pool.imap_unordered(upload_key, iter):
         if error:
             raise OSError(error)
         elif path:
-            print(path)
+            _log(path)
     pool.close()
     pool.join()
 
@@ -452,7 +716,13 @@ def backup(config, scrub_acls, scrub, bucket):
     else:
         scrub = SCRUB_NONE
     if not sync_bucket(
-        server, bucket, root_dir, workers=workers, scrub=scrub, secure=secure
+        server,
+        bucket,
+        root_dir,
+        workers=workers,
+        scrub=scrub,
+        secure=secure,
+        bloom_gc=settings.get("rgw-bloom-gc", False),
     ):
         sys.exit(1)
 
@@ -52,11 +52,25 @@ def run_rsync(cmd):
 
     # Filter out spurious log output from
     # https://bugzilla.samba.org/show_bug.cgi?id=10496
-    spurious = re.compile(r"[.h][dfL]\.{8}x ")
-    for raw_line in proc.stdout:
-        line = raw_line.decode(sys.stdout.encoding)
-        if not spurious.match(line):
-            print(line.strip())
+    spurious = re.compile(rb"[.h][dfL]\.{8}x ")
+    # -i prints a line per file, so pass the output through as bytes a
+    # chunk at a time, rather than decoding and printing each line
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    partial = b""
+    while True:
+        buf = os.read(proc.stdout.fileno(), 1 << 16)
+        if buf:
+            lines = (partial + buf).split(b"\n")
+            partial = lines.pop()
+        else:
+            lines = [partial] if partial else []
+        out.write(
+            b"".join(line.strip() + b"\n" for line in lines if not spurious.match(line))
+        )
+        out.flush()
+        if not buf:
+            break
 
     return proc.wait()
 
@@ -161,8 +175,11 @@ def backup(config, scrub, host):
     settings = config["settings"]
     info = config["rsync"][host]
     root_dir = os.path.join(settings["root"], get_relroot(host, info))
-    exclude = settings.get("rsync-exclude", [])
-    exclude.extend(info.get("exclude", []))
+    # Copy rather than extending the settings list in place, and drop
+    # patterns given both globally and for the host
+    exclude = list(
+        dict.fromkeys(settings.get("rsync-exclude", []) + info.get("exclude", []))
+    )
     rsync = settings.get("rsync-local-binary")
     user = info.get("user", "root")
 
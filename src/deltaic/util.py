@@ -24,19 +24,26 @@ import calendar
 import contextlib
 import errno
 import fcntl
+import functools
+import hashlib
 import os
+import queue
 import random
 import secrets
 import subprocess
+import sys
+import threading
 from contextlib import contextmanager
 from io import BytesIO
 from tempfile import mkdtemp, mkstemp
-from typing import Union
+from typing import Dict, List, Optional, Set, Union
 
 import xattr
 from pybloom_live import ScalableBloomFilter
 
 TEMPFILE_PREFIX = ".backup-tmp"
+# Linux can create a file without a directory entry and link it in later
+_HAVE_TMPFILE = hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd")
 
 
 class LockConflict(Exception):
@@ -44,7 +51,11 @@ class LockConflict(Exception):
 
 
 class BloomSet:
-    def __init__(self, initial_capacity=1000, error_rate=0.0001):
+    # The scalable filter grows by chaining new filters, and every lookup
+    # has to hash the key for each filter in the chain.  Start out large
+    # enough (about 300 KiB of bits) that typical sets fit in one or two
+    # filters.
+    def __init__(self, initial_capacity=1 << 17, error_rate=0.0001):
         self._set = ScalableBloomFilter(
             initial_capacity=initial_capacity,
             error_rate=error_rate,
@@ -68,18 +79,46 @@ class BloomSet:
         return self._bloom_salt + name
 
 
+class DigestSet:
+    """Exact alternative to BloomSet for sets small enough to keep in
+    memory.  Stores a fixed-size digest of each name rather than the name
+    itself, so memory use doesn't depend on path length."""
+
+    DIGEST_SIZE = 16
+
+    def __init__(self):
+        self._set: Set[bytes] = set()
+
+    def add(self, name):
+        self._set.add(self._digest(name))
+
+    def __contains__(self, name):
+        return self._digest(name) in self._set
+
+    def _digest(self, name):
+        if isinstance(name, str):
+            name = name.encode(errors="xmlcharrefreplace")
+        return hashlib.blake2b(name, digest_size=self.DIGEST_SIZE).digest()
+
+
 def gc_directory_tree(root_dir, valid_paths, report_callback=None):
     if report_callback is None:
 
         def report_callback(path, is_dir):
             pass
 
-    def handle_err(err):
-        raise err
-
-    for dirpath, _, filenames in os.walk(root_dir, topdown=False, onerror=handle_err):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
+    def gc_dir(dirpath):
+        # Walk bottom-up, so directories are empty by the time we try to
+        # remove them.  Symlinks to directories are treated as files.
+        filepaths = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    gc_dir(entry.path)
+                else:
+                    filepaths.append(entry.path)
+
+        for filepath in filepaths:
             if filepath not in valid_paths:
                 report_callback(filepath, False)
                 os.unlink(filepath)
@@ -91,6 +130,8 @@ def gc_directory_tree(root_dir, valid_paths, report_callback=None):
                 # Directory not empty
                 pass
 
+    gc_dir(root_dir)
+
 
 @contextmanager
 def noop(value=None):
@@ -105,36 +146,117 @@ def try_open(path: Union[str, bytes, os.PathLike], mode: str):
 
 
 @contextmanager
-def write_atomic(path, prefix=TEMPFILE_PREFIX, suffix=""):
+def write_atomic(path, prefix=TEMPFILE_PREFIX, suffix="", nocache=False):
     # Open a temporary file for writing.  On successfully exiting the
     # context, close the file and rename it to the specified path.
     # On exiting due to exception, close and delete the temporary file.
+    # If nocache is True, advise the kernel that we won't be reading the
+    # data back, so backup traffic doesn't push other data out of the
+    # page cache.
     #
     # Any source using this function must eventually garbage-collect
     # temporary files, and must ignore them during restores.
-    fd, tempfile = mkstemp(prefix=prefix, suffix=suffix, dir=os.path.dirname(path))
+    dirname = os.path.dirname(path)
+    fd = _open_unnamed(dirname)
+    if fd is not None:
+        # The file has no name until we link it in, so an abort or crash
+        # while writing leaves nothing behind
+        with os.fdopen(fd, "wb") as fh:
+            yield fh
+            if nocache:
+                drop_cache(fh)
+            os.fchmod(fd, 0o644)
+            _link_unnamed(fd, path, prefix, suffix)
+        return
+
+    fd, tempfile = mkstemp(prefix=prefix, suffix=suffix, dir=dirname)
     try:
         with os.fdopen(fd, "wb") as fh:
             yield fh
-        os.chmod(tempfile, 0o644)
+            if nocache:
+                drop_cache(fh)
+            os.fchmod(fd, 0o644)
+        os.rename(tempfile, path)
+    except BaseException:
+        os.unlink(tempfile)
+        raise
+
+
+def _open_unnamed(dirname):
+    # Create an anonymous file in dirname, or return None if the platform
+    # or filesystem doesn't support that
+    if not _HAVE_TMPFILE:
+        return None
+    try:
+        return os.open(dirname or ".", os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except OSError:
+        return None
+
+
+def _link_unnamed(fd, path, prefix, suffix):
+    fdpath = f"/proc/self/fd/{fd}"
+    # Python only passes AT_SYMLINK_FOLLOW to linkat() when a dir_fd is
+    # given.  fdpath is absolute, so the kernel ignores the dir_fd itself.
+    link = functools.partial(os.link, src_dir_fd=fd, follow_symlinks=True)
+    try:
+        link(fdpath, path)
+        return
+    except FileExistsError:
+        pass
+    # Replacing an existing file; link to a temporary name and rename over
+    # it instead
+    while True:
+        tempfile = os.path.join(
+            os.path.dirname(path), prefix + secrets.token_hex(4) + suffix
+        )
+        try:
+            link(fdpath, tempfile)
+            break
+        except FileExistsError:
+            pass
+    try:
         os.rename(tempfile, path)
     except BaseException:
         os.unlink(tempfile)
         raise
 
 
+def drop_cache(fh):
+    # Dirty pages are only evicted once written back; this starts the
+    # writeback and drops whatever is already clean.
+    fh.flush()
+    os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
 class UpdateFile:
     """File-like object, only for writing, which atomically overwrites
     the specified file only if the new data is different from the old.
     Avoids unnecessary LVM COW.
 
+    If the caller knows the size of the new data, passing it lets an old
+    file of a different size be replaced without first being read back.
+    A wrong size only costs a needless rewrite.
+
     Any source using this class must eventually garbage-collect temporary
     files, and must ignore them during restores."""
 
-    def __init__(self, path, prefix=TEMPFILE_PREFIX, suffix="", block_size=256 << 10):
+    def __init__(
+        self,
+        path,
+        prefix=TEMPFILE_PREFIX,
+        suffix="",
+        block_size=256 << 10,
+        nocache=False,
+        size=None,
+    ):
         self.modified = None
-        self._coroutine = self._start_coroutine(path, prefix, suffix, block_size)
-        self._buf = b""
+        self._coroutine = self._start_coroutine(
+            path, prefix, suffix, block_size, nocache, size
+        )
+        # Callers such as github3's asset download write in small chunks.
+        # Appending to a bytearray is amortized O(1); concatenating bytes
+        # would recopy the whole pending block on every write.
+        self._buf = bytearray()
         self._desired_size = next(self._coroutine)
 
     def __enter__(self):
@@ -150,6 +272,15 @@ class UpdateFile:
         self.close()
 
     def write(self, buf):
+        if not self._buf:
+            # Feed whole blocks straight from the caller's buffer, rather
+            # than first copying all of it into ours
+            view = memoryview(buf)
+            while len(view) >= self._desired_size:
+                count = self._desired_size
+                self._send_bytes(bytes(view[:count]))
+                view = view[count:]
+            buf = view
         self._buf += buf
         while len(self._buf) >= self._desired_size:
             self._send(self._desired_size)
@@ -168,14 +299,17 @@ class UpdateFile:
 
     def _send(self, len):
         assert self._coroutine
-        buf = self._buf[0 : self._desired_size]
-        self._buf = self._buf[self._desired_size :]
+        buf = bytes(self._buf[0 : self._desired_size])
+        del self._buf[0 : self._desired_size]
+        self._send_bytes(buf)
+
+    def _send_bytes(self, buf):
         try:
             self._desired_size = self._coroutine.send(buf)
         except StopIteration:
             self._coroutine = None
 
-    def _start_coroutine(self, path, prefix, suffix, block_size):
+    def _start_coroutine(self, path, prefix, suffix, block_size, nocache, size):
         # "buf = input_data.read(count)" is spelled "buf = yield count".
 
         # Open old file if it exists
@@ -184,13 +318,21 @@ class UpdateFile:
             prefix_len = 0
             databuf = b""
             if oldfh is not None:
-                while oldfh:
+                if nocache:
+                    os.posix_fadvise(oldfh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                # If the caller told us the new size, a mismatch means
+                # there's nothing to compare
+                comparing = size is None or os.fstat(oldfh.fileno()).st_size == size
+                while comparing:
                     oldbuf = oldfh.read(block_size)
                     if oldbuf == b"":
                         databuf = yield block_size
                         if databuf == b"":
                             # Files are identical
                             self.modified = False
+                            if nocache:
+                                # The comparison pulled it into the cache
+                                drop_cache(oldfh)
                             return
                         break
                     databuf = yield len(oldbuf)
@@ -199,7 +341,9 @@ class UpdateFile:
                     prefix_len += len(databuf)
 
             # Write new file
-            with write_atomic(path, prefix=prefix, suffix=suffix) as newfh:
+            with write_atomic(
+                path, prefix=prefix, suffix=suffix, nocache=nocache
+            ) as newfh:
                 # Copy common prefix
                 if oldfh is not None:
                     oldfh.seek(0)
@@ -218,10 +362,14 @@ class UpdateFile:
                         break
                     newfh.write(databuf)
 
+            if nocache and oldfh is not None:
+                drop_cache(oldfh)
             self.modified = True
 
 
-def update_file(path, data, prefix=TEMPFILE_PREFIX, suffix="", block_size=256 << 10):
+def update_file(
+    path, data, prefix=TEMPFILE_PREFIX, suffix="", block_size=256 << 10, nocache=False
+):
     # Avoid unnecessary LVM COW by only updating the file if its data has
     # changed.  data can be a string or a file-like object which does
     # not need to be seekable.
@@ -229,7 +377,19 @@ def update_file(path, data, prefix=TEMPFILE_PREFIX, suffix="", block_size=256 <<
     # Any source using this function must eventually garbage-collect
     # temporary files, and must ignore them during restores.
 
-    with UpdateFile(path, prefix=prefix, suffix=suffix, block_size=block_size) as fh:
+    size = None
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if isinstance(data, bytes):
+        size = len(data)
+    with UpdateFile(
+        path,
+        prefix=prefix,
+        suffix=suffix,
+        block_size=block_size,
+        nocache=nocache,
+        size=size,
+    ) as fh:
         if hasattr(data, "read"):
             while True:
                 buf = data.read(block_size)
@@ -237,8 +397,6 @@ def update_file(path, data, prefix=TEMPFILE_PREFIX, suffix="", block_size=256 <<
                     break
                 fh.write(buf)
         else:
-            if isinstance(data, str):
-                data = data.encode("utf-8")
             fh.write(data)
     return fh.modified
 
@@ -253,11 +411,8 @@ def _test_update_file():
             fh.write(data)
 
     def change_byte(data, index):
-        char = ord(data[index])
-        char += 1
-        if char > 255:
-            char = 0
-        return data[0:index] + chr(char) + data[index + 1 :]
+        char = (data[index] + 1) % 256
+        return data[0:index] + bytes([char]) + data[index + 1 :]
 
     def check(data):
         with open(path, "rb") as fh:
@@ -383,6 +538,39 @@ class XAttrs:
             del self._attrs[key]
 
 
+class CachedXAttrs(XAttrs):
+    """XAttrs wrapper that remembers values it has read or written, so that
+    reading a key and later updating it costs one getxattr() rather than
+    two.  Only use this while nothing else modifies the attributes."""
+
+    def __init__(self, path):
+        XAttrs.__init__(self, path)
+        self._cache: Dict[str, Optional[str]] = {}
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if key not in self._cache:
+            self._cache[key] = XAttrs.get(self, key)
+        value = self._cache[key]
+        return default if value is None else value
+
+    def update(self, key, value):
+        XAttrs.update(self, key, value)
+        self._cache[key] = value
+
+    def delete(self, key):
+        XAttrs.delete(self, key)
+        self._cache[key] = None
+
+
 def random_do_work(settings, option, default_probability):
     # Decide probabilistically whether to do some extra work.
     return random.random() < settings.get(option, default_probability)
@@ -394,11 +582,15 @@ def datetime_to_time_t(dt):
 
 def make_dir_path(*args):
     path = os.path.join(*args)
+    # Usually the directory already exists, or only its last component is
+    # missing.  A single mkdir() settles both; os.makedirs() would stat()
+    # the parent first.
     try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+        os.mkdir(path)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
     return path
 
 
@@ -411,6 +603,104 @@ def humanize_size(size: float) -> str:
     return f"{size:.1f} {units[index]}"
 
 
+class LogSink:
+    """Accumulate per-object progress lines and write them to a file
+    descriptor in large chunks.  print() issues at least one write per
+    line, which adds up when a backup touches millions of objects."""
+
+    def __init__(self, fd=1, bufsize=64 << 10):
+        self._fd = fd
+        self._bufsize = bufsize
+        self._buf: List[bytes] = []
+        self._len = 0
+        self._lock = threading.Lock()
+
+    def log(self, *args):
+        line = " ".join(str(arg) for arg in args) + "\n"
+        data = line.encode(sys.stdout.encoding or "utf-8", errors="backslashreplace")
+        with self._lock:
+            self._buf.append(data)
+            self._len += len(data)
+            if self._len >= self._bufsize:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buf:
+            return
+        # Keep ordering with anything already written through sys.stdout
+        sys.stdout.flush()
+        data = b"".join(self._buf)
+        self._buf = []
+        self._len = 0
+        while data:
+            count = os.write(self._fd, data)
+            data = data[count:]
+
+
+def prefetch_iter(iterable, maxsize=200):
+    """Iterate over iterable in a background thread, keeping up to maxsize
+    items ready.  This overlaps a producer that blocks, e.g. on paginated
+    network requests, with the caller's processing of earlier items.
+    Exceptions raised by the iterable are re-raised to the caller."""
+    return merge_iters([iterable], maxsize)
+
+
+def merge_iters(iterables, maxsize=200):
+    """Like prefetch_iter(), but drain several iterables concurrently, one
+    thread apiece, yielding their items in the order they arrive."""
+    items: queue.Queue = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Don't block forever if the caller has stopped consuming
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker(iterable):
+        # Reported if a BaseException kills the thread, since the
+        # consumer must still see an end marker from every worker
+        error: Optional[BaseException] = RuntimeError("merge_iters worker died")
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            error = None
+        except Exception as e:
+            error = e
+        finally:
+            put((False, error))
+
+    threads = [
+        threading.Thread(target=worker, args=[iterable], daemon=True)
+        for iterable in iterables
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            ok, item = items.get()
+            if ok:
+                yield item
+            elif item is None:
+                running -= 1
+            else:
+                raise item
+    finally:
+        stop.set()
+    for thread in threads:
+        thread.join()
+
+
 class Pipeline:
     def __init__(self, cmds, in_fh=None, out_fh=None, env=None):
         self._procs = []